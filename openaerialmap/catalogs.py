@@ -1,10 +1,10 @@
 # coding=utf-8
 
-import json
 import logging
 import math
 import multiprocessing
 import os
+import threading
 import unicodedata
 from concurrent import futures
 from distutils.util import strtobool
@@ -13,9 +13,15 @@ from itertools import chain
 import boto3
 import requests
 from boto3.session import Config
+from botocore.exceptions import ClientError
+from cachetools import LRUCache, TTLCache
+from dateutil.parser import parse as parse_datetime
+from dateutil.tz import tzutc
+from requests.adapters import HTTPAdapter
 
-import arrow
+import numpy as np
 from marblecutter import (
+    WEB_MERCATOR_CRS,
     Bounds,
     NoCatalogAvailable,
     get_resolution_in_meters,
@@ -31,8 +37,26 @@ try:
 except ImportError:
     from urllib.parse import urlparse
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    text_type = unicode  # noqa
+except NameError:
+    text_type = str
+
 LOG = logging.getLogger(__name__)
 
+# number of concurrent metadata fetches (and pooled connections to serve them)
+CONCURRENCY = multiprocessing.cpu_count() * 5
+# seconds to wait for connections to remote metadata hosts and their responses
+HTTP_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05)),
+    float(os.getenv("HTTP_READ_TIMEOUT", 5)),
+)
+
 # GDAL-compatible environment variables
 AWS_S3_ENDPOINT = os.getenv("AWS_S3_ENDPOINT")
 AWS_HTTPS = bool(strtobool(os.getenv("AWS_HTTPS", "YES")))
@@ -46,25 +70,212 @@ else:
     endpoint_url = None
 
 if AWS_VIRTUAL_HOSTING:
-    config = Config(s3={"addressing_style": "virtual"})
+    addressing_style = "virtual"
 else:
     # disable virtual hosting (<bucket>.endpoint_url)
-    config = Config(s3={"addressing_style": "path"})
+    addressing_style = "path"
+
+# the client is shared across threads, so size its pool to match them
+config = Config(
+    connect_timeout=HTTP_TIMEOUT[0],
+    read_timeout=HTTP_TIMEOUT[1],
+    max_pool_connections=CONCURRENCY,
+    retries={"max_attempts": 3},
+    s3={"addressing_style": addressing_style},
+)
 
 S3 = boto3.client("s3", endpoint_url=endpoint_url, config=config)
 
+# shared session so that metadata fetches reuse keep-alive connections
+SESSION = requests.Session()
+adapter = HTTPAdapter(pool_connections=CONCURRENCY, pool_maxsize=CONCURRENCY)
+SESSION.mount("http://", adapter)
+SESSION.mount("https://", adapter)
+
+# shared by all scenes so that concurrent scene loads don't each spin up (and tear
+# down) a pool of their own
+EXECUTOR = futures.ThreadPoolExecutor(max_workers=CONCURRENCY)
+
+# parsed scene metadata, keyed by URI and validated against its ETag
+SCENE_CACHE = LRUCache(maxsize=int(os.getenv("SCENE_CACHE_SIZE", 1024)))
+SCENE_CACHE_LOCK = threading.Lock()
+
+# attributes derived from OIN metadata (and its source), keyed by metadata URI and
+# validated against the metadata's ETag
+OIN_META_CACHE = LRUCache(maxsize=int(os.getenv("OIN_META_CACHE_SIZE", 4096)))
+OIN_META_CACHE_LOCK = threading.Lock()
+
+# fully constructed OIN catalogs, shared by all scenes that include them; once they
+# expire, they're cheaply revalidated using OIN_META_CACHE
+OIN_CATALOG_CACHE = TTLCache(
+    maxsize=int(os.getenv("OIN_CATALOG_CACHE_SIZE", 4096)),
+    ttl=int(os.getenv("OIN_CATALOG_CACHE_TTL", 3600)),
+)
+OIN_CATALOG_CACHE_LOCK = threading.Lock()
+
+
+# S3 reports missing keys as AccessDenied / 403 to principals without s3:ListBucket
+S3_MISSING_CODES = ("403", "404", "AccessDenied", "NoSuchKey")
+
+
+class CatalogNotFound(NoCatalogAvailable):
+    """A catalog (or a document it requires) definitely doesn't exist."""
+
+
+def _fetch_json(uri, etag=None):
+    """Fetch and parse a JSON document.
+
+    Returns an (etag, data) tuple; data is None if the document still matches the
+    provided ETag.
+    """
+    if uri.startswith("s3://"):
+        url = urlparse(uri)
+        kwargs = {"Bucket": url.netloc, "Key": url.path[1:]}
+
+        if etag is not None:
+            kwargs["IfNoneMatch"] = etag
+
+        try:
+            obj = S3.get_object(**kwargs)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+
+            if code == "304":
+                return etag, None
+
+            if code in S3_MISSING_CODES:
+                raise CatalogNotFound()
+
+            raise
+
+        return obj.get("ETag"), json_loads(obj["Body"].read())
+    elif uri.startswith(("http://", "https://")):
+        headers = {}
+
+        if etag is not None:
+            headers["If-None-Match"] = etag
+
+        rsp = SESSION.get(uri, headers=headers, timeout=HTTP_TIMEOUT)
+
+        if rsp.status_code == 304:
+            return etag, None
+
+        if rsp.status_code == 404:
+            raise CatalogNotFound()
+
+        rsp.raise_for_status()
+
+        return rsp.headers.get("ETag"), json_loads(rsp.content)
+
+    raise NoCatalogAvailable()
+
+
+def document_exists(uri):
+    """Check whether a document exists without fetching it."""
+    if uri.startswith("s3://"):
+        url = urlparse(uri)
+
+        try:
+            S3.head_object(Bucket=url.netloc, Key=url.path[1:])
+        except ClientError as e:
+            if e.response["Error"]["Code"] in S3_MISSING_CODES:
+                return False
+            raise
+
+        return True
+    elif uri.startswith(("http://", "https://")):
+        rsp = SESSION.head(uri, allow_redirects=True, timeout=HTTP_TIMEOUT)
+
+        if rsp.status_code == 404:
+            return False
+
+        rsp.raise_for_status()
+
+        return True
+
+    return False
+
+
+def _fetch_oin_meta(uri, revalidate=True):
+    etag = None
+
+    if revalidate:
+        with OIN_META_CACHE_LOCK:
+            etag, _ = OIN_META_CACHE.get(uri, (None, None))
+
+    try:
+        return _fetch_json(uri, etag)
+    except NoCatalogAvailable:
+        raise
+    except Exception:
+        raise NoCatalogAvailable()
+
+
+def _to_ascii(value):
+    # metadata is parsed JSON, so strings are unicode on Python 2 as well
+    if not isinstance(value, text_type):
+        return None
+
+    try:
+        # most values are already ASCII and don't need to be decomposed
+        return value.encode("ascii")
+    except UnicodeError:
+        return unicodedata.normalize("NFKD", value).encode("ascii", "ignore")
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+
+    try:
+        timestamp = parse_datetime(value)
+    except (OverflowError, TypeError, ValueError):
+        # treat unparseable timestamps as missing
+        return None
+
+    # treat timestamps without an offset as UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=tzutc())
+
+    return timestamp
+
+
+def _format_date(timestamp):
+    # M/D/YYYY
+    return "{}/{}/{}".format(timestamp.month, timestamp.day, timestamp.year)
+
+
+def _format_timestamp(timestamp):
+    # YYYY-MM-DDTHH:mm:ss+HH:MM
+    return timestamp.replace(microsecond=0).isoformat()
+
 
 class OAMSceneCatalog(Catalog):
 
+    __slots__ = (
+        "_bounds",
+        "_center",
+        "_extents",
+        "_maxzoom",
+        "_maxzooms",
+        "_minzoom",
+        "_minzooms",
+        "_name",
+        "_sources",
+        "_web_mercator_extents",
+    )
+
     def __init__(self, uri):
-        if uri.startswith("s3://"):
-            url = urlparse(uri)
-            obj = S3.get_object(Bucket=url.netloc, Key=url.path[1:])
-            scene = json.loads(obj["Body"].read().decode("utf-8"))
-        elif uri.startswith(("http://", "https://")):
-            scene = requests.get(uri).json()
-        else:
-            raise NoCatalogAvailable()
+        with SCENE_CACHE_LOCK:
+            cached_etag, cached_scene = SCENE_CACHE.get(uri, (None, None))
+
+        etag, scene = _fetch_json(uri, cached_etag)
+
+        if scene is None:
+            scene = cached_scene
+        elif etag is not None:
+            with SCENE_CACHE_LOCK:
+                SCENE_CACHE[uri] = (etag, scene)
 
         self._bounds = scene["bounds"]
         self._center = scene["center"]
@@ -72,35 +283,109 @@ class OAMSceneCatalog(Catalog):
         self._minzoom = scene["minzoom"]
         self._name = scene["name"]
 
-        def _build_catalog(source):
-            return OINMetaCatalog(
-                source["meta"]["source"].replace("_warped.vrt", "_meta.json")
-            )
+        meta_uris = [
+            source["meta"]["source"].replace("_warped.vrt", "_meta.json")
+            for source in reversed(scene["meta"]["sources"])
+        ]
 
-        sources = list(reversed(scene["meta"]["sources"]))
-        with futures.ThreadPoolExecutor(
-            max_workers=multiprocessing.cpu_count() * 5
-        ) as executor:
-            self._sources = list(executor.map(_build_catalog, sources))
+        catalogs = {}
+
+        with OIN_CATALOG_CACHE_LOCK:
+            for meta_uri in meta_uris:
+                catalog = OIN_CATALOG_CACHE.get(meta_uri)
+
+                if catalog is not None:
+                    catalogs[meta_uri] = catalog
+
+        missing = list(set(meta_uris) - set(catalogs))
+
+        # fetch all metadata up front, then build catalogs from it (which is still
+        # fanned out, as it opens each source)
+        responses = list(EXECUTOR.map(_fetch_oin_meta, missing))
+        built = list(EXECUTOR.map(OINMetaCatalog, missing, responses))
+
+        with OIN_CATALOG_CACHE_LOCK:
+            OIN_CATALOG_CACHE.update(zip(missing, built))
+
+        catalogs.update(zip(missing, built))
+        self._sources = [catalogs[meta_uri] for meta_uri in meta_uris]
+
+        # source extents and zoom ranges, for selecting sources without visiting
+        # each of them
+        self._extents = np.array(
+            [s._bounds for s in self._sources], dtype=np.float64
+        ).reshape(-1, 4)
+        self._web_mercator_extents = np.array(
+            [s._web_mercator_bounds for s in self._sources], dtype=np.float64
+        ).reshape(-1, 4)
+        self._minzooms = np.array([s._minzoom for s in self._sources])
+        self._maxzooms = np.array([s._maxzoom for s in self._sources])
 
     def get_sources(self, bounds, resolution):
-        return chain(*[s.get_sources(bounds, resolution) for s in self._sources])
+        query, bounds_crs = bounds
+        zoom = get_zoom(max(resolution))
+
+        if bounds_crs == WEB_MERCATOR_CRS:
+            extents = self._web_mercator_extents
+        else:
+            extents = self._extents
+
+            if bounds_crs != WGS84_CRS:
+                query = warp.transform_bounds(bounds_crs, WGS84_CRS, *query)
+
+        left, bottom, right, top = query
+        matches = np.flatnonzero(
+            (extents[:, 0] <= right)
+            & (extents[:, 2] >= left)
+            & (extents[:, 1] <= top)
+            & (extents[:, 3] >= bottom)
+            & (self._minzooms <= zoom)
+            & (self._maxzooms >= zoom)
+        )
+
+        return chain.from_iterable(self._sources[i]._matched_sources() for i in matches)
 
 
 class OINMetaCatalog(Catalog):
 
-    def __init__(self, uri):
-        try:
-            if uri.startswith("s3://"):
-                url = urlparse(uri)
-                obj = S3.get_object(Bucket=url.netloc, Key=url.path[1:])
-                oin_meta = json.loads(obj["Body"].read().decode("utf-8"))
-            elif uri.startswith(("http://", "https://")):
-                oin_meta = requests.get(uri).json()
-            else:
-                raise NoCatalogAvailable()
-        except Exception:
-            raise NoCatalogAvailable()
+    # attributes that can be restored from OIN_META_CACHE
+    _CACHED_ATTRS = (
+        "_bounds",
+        "_cached_source",
+        "_center",
+        "_dtype",
+        "_headers",
+        "_maxzoom",
+        "_meta",
+        "_metadata_url",
+        "_minzoom",
+        "_name",
+        "_provider",
+        "_resolution",
+        "_source",
+        "_web_mercator_bounds",
+    )
+
+    __slots__ = _CACHED_ATTRS
+
+    def __init__(self, uri, response=None):
+        if response is None:
+            response = _fetch_oin_meta(uri)
+
+        etag, oin_meta = response
+
+        if oin_meta is None:
+            with OIN_META_CACHE_LOCK:
+                cached_etag, attrs = OIN_META_CACHE.get(uri, (None, None))
+
+            if attrs is not None and cached_etag == etag:
+                for k, v in attrs.items():
+                    setattr(self, k, v)
+
+                return
+
+            # the cached copy was evicted after being revalidated
+            etag, oin_meta = _fetch_oin_meta(uri, revalidate=False)
 
         self._meta = oin_meta
         self._metadata_url = uri
@@ -110,34 +395,14 @@ class OINMetaCatalog(Catalog):
 
         with get_source(self._source) as src:
             self._bounds = warp.transform_bounds(src.crs, WGS84_CRS, *src.bounds)
+            self._web_mercator_bounds = warp.transform_bounds(
+                src.crs, WEB_MERCATOR_CRS, *src.bounds
+            )
             self._resolution = get_resolution_in_meters(
                 Bounds(src.bounds, src.crs), (src.height, src.width)
             )
             approximate_zoom = get_zoom(max(self._resolution), op=math.ceil)
-
-            if src.meta["dtype"] != "uint8":
-                global_min = src.get_tag_item("TIFFTAG_MINSAMPLEVALUE")
-                global_max = src.get_tag_item("TIFFTAG_MAXSAMPLEVALUE")
-
-                for band in range(0, src.count):
-                    self._meta["values"] = self._meta.get("values", {})
-                    self._meta["values"][band] = {}
-                    min_val = src.get_tag_item("STATISTICS_MINIMUM", bidx=band + 1)
-                    max_val = src.get_tag_item("STATISTICS_MAXIMUM", bidx=band + 1)
-                    mean_val = src.get_tag_item("STATISTICS_MEAN", bidx=band + 1)
-
-                    if min_val is not None:
-                        self._meta["values"][band]["min"] = float(min_val)
-                    elif global_min is not None:
-                        self._meta["values"][band]["min"] = float(global_min)
-
-                    if max_val is not None:
-                        self._meta["values"][band]["max"] = float(max_val)
-                    elif global_max is not None:
-                        self._meta["values"][band]["max"] = float(global_max)
-
-                    if mean_val is not None:
-                        self._meta["values"][band]["mean"] = float(mean_val)
+            self._dtype = src.meta["dtype"]
 
         self._center = [
             (self._bounds[0] + self.bounds[2]) / 2,
@@ -146,79 +411,137 @@ class OINMetaCatalog(Catalog):
         ]
         self._maxzoom = approximate_zoom + 3
         self._minzoom = approximate_zoom - 10
-
-    def get_sources(self, bounds, resolution):
-        bounds, bounds_crs = bounds
-        zoom = get_zoom(max(resolution))
-        left, bottom, right, top = warp.transform_bounds(bounds_crs, WGS84_CRS, *bounds)
-
-        if (
-            (
-                self._bounds[0] <= left <= self._bounds[2]
-                or self._bounds[0] <= right <= self._bounds[2]
-            )
-            and (
-                self._bounds[1] <= bottom <= self._bounds[3]
-                or self._bounds[1] <= top <= self._bounds[3]
-            )
-            and (self._minzoom <= zoom <= self._maxzoom)
-        ):
-            yield Source(
+        # built on first use; scenes don't use the headers of their sources
+        self._headers = None
+        self._cached_source = (
+            Source(
                 self._source,
                 self._name,
                 self._resolution,
                 {},
                 self._meta,
                 {"imagery": True},
-            )
+            ),
+        )
+
+        if etag is not None:
+            attrs = {k: getattr(self, k) for k in self._CACHED_ATTRS}
+
+            with OIN_META_CACHE_LOCK:
+                OIN_META_CACHE[uri] = (etag, attrs)
+
+    def get_sources(self, bounds, resolution):
+        bounds, bounds_crs = bounds
+
+        if not self._minzoom <= get_zoom(max(resolution)) <= self._maxzoom:
+            return ()
+
+        # compare directly against pre-transformed bounds for common CRSes
+        if bounds_crs == WEB_MERCATOR_CRS:
+            extent = self._web_mercator_bounds
+        else:
+            extent = self._bounds
+
+            if bounds_crs != WGS84_CRS:
+                bounds = warp.transform_bounds(bounds_crs, WGS84_CRS, *bounds)
+
+        left, bottom, right, top = bounds
+
+        if (
+            left <= extent[2]
+            and right >= extent[0]
+            and bottom <= extent[3]
+            and top >= extent[1]
+        ):
+            return self._matched_sources()
+
+        return ()
+
+    def _matched_sources(self):
+        # band statistics are only read once the source is actually rendered
+        self._load_values()
+
+        return self._cached_source
+
+    @property
+    def values(self):
+        self._load_values()
+
+        return self._meta.get("values", {})
+
+    def _load_values(self):
+        if self._dtype == "uint8" or "values" in self._meta:
+            return
+
+        values = {}
+
+        with get_source(self._source) as src:
+            # read each metadata domain once rather than item by item
+            tags = src.tags()
+            global_min = tags.get("TIFFTAG_MINSAMPLEVALUE")
+            global_max = tags.get("TIFFTAG_MAXSAMPLEVALUE")
+
+            for band in range(0, src.count):
+                values[band] = {}
+                band_tags = src.tags(bidx=band + 1)
+                min_val = band_tags.get("STATISTICS_MINIMUM")
+                max_val = band_tags.get("STATISTICS_MAXIMUM")
+                mean_val = band_tags.get("STATISTICS_MEAN")
+
+                if min_val is not None:
+                    values[band]["min"] = float(min_val)
+                elif global_min is not None:
+                    values[band]["min"] = float(global_min)
+
+                if max_val is not None:
+                    values[band]["max"] = float(max_val)
+                elif global_max is not None:
+                    values[band]["max"] = float(global_max)
+
+                if mean_val is not None:
+                    values[band]["mean"] = float(mean_val)
+
+        # populated all at once, as the Source shares this dict with other threads
+        self._meta["values"] = values
 
     @property
     def headers(self):
+        if self._headers is None:
+            self._headers = self._make_headers()
+
+        return self._headers
+
+    def _make_headers(self):
         headers = {"X-OIN-Metadata-URL": self._metadata_url}
 
-        if "acquisition_start" in self._meta or "acquisition_end" in self._meta:
-            start = self._meta.get("acquisition_start")
-            end = self._meta.get("acquisition_end")
-
-            if start and end:
-                start = arrow.get(start)
-                end = arrow.get(end)
-
-                capture_range = "{}-{}".format(
-                    start.format("M/D/YYYY"), end.format("M/D/YYYY")
-                )
-                headers["X-OIN-Acquisition-Start"] = start.format(
-                    "YYYY-MM-DDTHH:mm:ssZZ"
-                )
-                headers["X-OIN-Acquisition-End"] = end.format("YYYY-MM-DDTHH:mm:ssZZ")
-            elif start:
-                start = arrow.get(start)
-
-                capture_range = start.format("M/D/YYYY")
-                headers["X-OIN-Acquisition-Start"] = start.format(
-                    "YYYY-MM-DDTHH:mm:ssZZ"
-                )
-            elif end:
-                end = arrow.get(end)
-
-                capture_range = end.format("M/D/YYYY")
-                headers["X-OIN-Acquisition-End"] = end.format("YYYY-MM-DDTHH:mm:ssZZ")
+        start = _parse_timestamp(self._meta.get("acquisition_start"))
+        end = _parse_timestamp(self._meta.get("acquisition_end"))
+        capture_range = None
+
+        if start and end:
+            capture_range = "{}-{}".format(_format_date(start), _format_date(end))
+        elif start:
+            capture_range = _format_date(start)
+        elif end:
+            capture_range = _format_date(end)
+
+        if start:
+            headers["X-OIN-Acquisition-Start"] = _format_timestamp(start)
+
+        if end:
+            headers["X-OIN-Acquisition-End"] = _format_timestamp(end)
 
+        if capture_range is not None:
             # Bing Maps-compatibility (JOSM uses this)
             headers["X-VE-TILEMETA-CaptureDatesRange"] = capture_range
 
-        if "provider" in self._meta:
-            headers["X-OIN-Provider"] = unicodedata.normalize(
-                "NFKD", self._meta["provider"]
-            ).encode(
-                "ascii", "ignore"
-            )
+        provider = _to_ascii(self._meta.get("provider"))
+        platform = _to_ascii(self._meta.get("platform"))
 
-        if "platform" in self._meta:
-            headers["X-OIN-Platform"] = unicodedata.normalize(
-                "NFKD", self._meta["platform"]
-            ).encode(
-                "ascii", "ignore"
-            )
+        if provider:
+            headers["X-OIN-Provider"] = provider
+
+        if platform:
+            headers["X-OIN-Platform"] = platform
 
         return headers
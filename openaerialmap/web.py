@@ -1,20 +1,38 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import hashlib
 import logging
 import os
+import threading
+import weakref
+from concurrent import futures
+from functools import partial
 
+from cachetools import TTLCache
 from cachetools.func import lru_cache
-from flask import jsonify, render_template, request, url_for
+from flask import Response, render_template, request, url_for
 from marblecutter import NoCatalogAvailable, tiling
 from marblecutter.catalogs.remote import RemoteCatalog
 from marblecutter.formats.optimal import Optimal
 from marblecutter.formats.png import PNG
 from marblecutter.transformations import Image
 from marblecutter.web import app
+from markupsafe import escape
 from mercantile import Tile
+from werkzeug.http import quote_etag
 
-from .catalogs import OAMSceneCatalog, OINMetaCatalog
+from .catalogs import (
+    CatalogNotFound,
+    OAMSceneCatalog,
+    OINMetaCatalog,
+    document_exists,
+)
+
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    from json import dumps as json_dumps
 
 LOG = logging.getLogger(__name__)
 
@@ -22,61 +40,303 @@ IMAGE_TRANSFORMATION = Image()
 PNG_FORMAT = PNG()
 OPTIMAL_FORMAT = Optimal()
 
+# looked up once; render_template accepts compiled templates as well as names
+WMTS_TEMPLATE = app.jinja_env.get_template("wmts.xml")
+# stands in for the (per-request) base URL in cached WMTS capabilities documents
+WMTS_BASE_URL_PLACEHOLDER = "__BASE_URL__"
+
 REMOTE_CATALOG_BASE_URL = os.getenv(
     "REMOTE_CATALOG_BASE_URL", "https://api.openaerialmap.org"
 )
 S3_BUCKET = os.getenv("S3_BUCKET")
-S3_PREFIX = os.getenv("S3_PREFIX", "")
+# normalized to either "" or "some/prefix/"
+S3_PREFIX = os.getenv("S3_PREFIX", "").strip("/")
 
-# normalize prefix
-if S3_PREFIX == "/":
-    S3_PREFIX = ""
-
-if not S3_PREFIX.endswith("/"):
+if S3_PREFIX:
     S3_PREFIX += "/"
 
-if S3_PREFIX.startswith("/"):
-    S3_PREFIX = S3_PREFIX[1:]
+# URL templates, with everything that's fixed at startup filled in
+_S3_URL_PREFIX = "s3://{}/{}".format(S3_BUCKET, S3_PREFIX)
+_SCENE_URL_FMT = _S3_URL_PREFIX + "{scene_id}/{scene_idx}/scene.json"
+_META_URL_FMT = _S3_URL_PREFIX + "{scene_id}/{scene_idx}/{image_id}_meta.json"
+_REMOTE_CATALOG_URL_FMT = REMOTE_CATALOG_BASE_URL + "/{type}/{id}/catalog.json"
+_REMOTE_TILES_URL_FMT = REMOTE_CATALOG_BASE_URL + "/{type}/{id}/{{z}}/{{x}}/{{y}}.json"
+
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", 2048))
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", 3600))
+REMOTE_CATALOG_CACHE_SIZE = int(
+    os.getenv("REMOTE_CATALOG_CACHE_SIZE", CATALOG_CACHE_SIZE)
+)
+REMOTE_CATALOG_CACHE_TTL = int(os.getenv("REMOTE_CATALOG_CACHE_TTL", CATALOG_CACHE_TTL))
+MISSING_CATALOG_CACHE_TTL = int(os.getenv("MISSING_CATALOG_CACHE_TTL", 60))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", 256))
+TILE_CACHE_TTL = int(os.getenv("TILE_CACHE_TTL", 3600))
+
+CATALOG_CACHE = TTLCache(maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+REMOTE_CATALOG_CACHE = TTLCache(
+    maxsize=REMOTE_CATALOG_CACHE_SIZE, ttl=REMOTE_CATALOG_CACHE_TTL
+)
+# keys (as in PENDING_LOADS) of catalogs recently found not to exist, so that
+# requests for them don't each go back to S3
+MISSING_CATALOGS = TTLCache(maxsize=65536, ttl=MISSING_CATALOG_CACHE_TTL)
+# rendered tiles (published scenes don't change)
+TILE_CACHE = TTLCache(maxsize=TILE_CACHE_SIZE, ttl=TILE_CACHE_TTL)
+# catalog documents known to exist, for previews (which don't need the catalog)
+EXISTING_CATALOGS = TTLCache(maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+# WMTS capabilities with a placeholder base URL, freed along with their catalogs
+WMTS_SKELETONS = weakref.WeakKeyDictionary()
+# in-flight loads, keyed by cache and key, so that concurrent misses share one
+PENDING_LOADS = {}
+CACHE_LOCK = threading.Lock()
+
 
+def _get_or_load(cache, key, loader):
+    pending_key = (id(cache), key)
+
+    with CACHE_LOCK:
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        if pending_key in MISSING_CATALOGS:
+            raise NoCatalogAvailable()
+
+        future = PENDING_LOADS.get(pending_key)
+        loading = future is None
+
+        if loading:
+            future = PENDING_LOADS[pending_key] = futures.Future()
+
+    if not loading:
+        return future.result()
 
-@lru_cache()
-def make_catalog(scene_id, scene_idx, image_id=None):
     try:
-        if image_id:
-            return OINMetaCatalog(
-                "s3://{}/{}{}/{}/{}_meta.json".format(
-                    S3_BUCKET, S3_PREFIX, scene_id, scene_idx, image_id
-                )
-            )
+        value = loader()
+    except BaseException as e:
+        # release waiters even when interrupted, lest they block forever
+        with CACHE_LOCK:
+            del PENDING_LOADS[pending_key]
 
-        return OAMSceneCatalog(
-            "s3://{}{}/{}/{}/scene.json".format(
-                S3_BUCKET, S3_PREFIX, scene_id, scene_idx
-            )
-        )
+            # only remember catalogs that are known not to exist; others may have
+            # failed transiently
+            if isinstance(e, CatalogNotFound):
+                MISSING_CATALOGS[pending_key] = True
+
+        future.set_exception(e)
+        raise
+
+    with CACHE_LOCK:
+        cache[key] = value
+        del PENDING_LOADS[pending_key]
+
+    future.set_result(value)
+
+    return value
+
+
+def _check_exists(cache, key, uri):
+    """Fail the way _get_or_load would, without loading the catalog."""
+    pending_key = (id(cache), key)
+
+    with CACHE_LOCK:
+        if key in cache or uri in EXISTING_CATALOGS:
+            return
+
+        if pending_key in MISSING_CATALOGS:
+            raise NoCatalogAvailable()
+
+    try:
+        exists = document_exists(uri)
     except Exception:
         raise NoCatalogAvailable()
 
+    with CACHE_LOCK:
+        if exists:
+            EXISTING_CATALOGS[uri] = True
+        else:
+            MISSING_CATALOGS[pending_key] = True
+
+    if not exists:
+        raise NoCatalogAvailable()
+
+
+def make_catalog(scene_id, scene_idx, image_id=None):
+    return _get_or_load(
+        CATALOG_CACHE,
+        (scene_id, scene_idx, image_id),
+        partial(_load_catalog, scene_id, scene_idx, image_id),
+    )
+
 
-@lru_cache()
 def make_remote_catalog(type, id):
-    try:
-        return RemoteCatalog(
-            "{}/{}/{}/catalog.json".format(REMOTE_CATALOG_BASE_URL, type, id),
-            "{}/{}/{}/{{z}}/{{x}}/{{y}}.json".format(REMOTE_CATALOG_BASE_URL, type, id),
+    return _get_or_load(
+        REMOTE_CATALOG_CACHE, (type, id), partial(_load_remote_catalog, type, id)
+    )
+
+
+def catalog_url(scene_id, scene_idx, image_id=None):
+    if image_id:
+        return _META_URL_FMT.format(
+            scene_id=scene_id, scene_idx=scene_idx, image_id=image_id
         )
+
+    return _SCENE_URL_FMT.format(scene_id=scene_id, scene_idx=scene_idx)
+
+
+def remote_catalog_url(type, id):
+    return _REMOTE_CATALOG_URL_FMT.format(type=type, id=id)
+
+
+def remote_tiles_url(type, id):
+    return _REMOTE_TILES_URL_FMT.format(type=type, id=id)
+
+
+def _load_catalog(scene_id, scene_idx, image_id=None):
+    uri = catalog_url(scene_id, scene_idx, image_id)
+
+    try:
+        if image_id:
+            return OINMetaCatalog(uri)
+
+        return OAMSceneCatalog(uri)
+    except NoCatalogAvailable:
+        raise
     except Exception:
         raise NoCatalogAvailable()
 
 
+def _load_remote_catalog(type, id):
+    try:
+        return RemoteCatalog(remote_catalog_url(type, id), remote_tiles_url(type, id))
+    except Exception:
+        pass
+
+    # RemoteCatalog doesn't say why it failed; check whether the catalog is missing
+    try:
+        exists = document_exists(remote_catalog_url(type, id))
+    except Exception:
+        exists = True
+
+    if not exists:
+        raise CatalogNotFound()
+
+    raise NoCatalogAvailable()
+
+
+def _render_tilejson(catalog, endpoint, **values):
+    tilejson = {
+        "bounds": catalog.bounds,
+        "center": catalog.center,
+        "maxzoom": catalog.maxzoom,
+        "minzoom": catalog.minzoom,
+        "name": catalog.name,
+        "tilejson": "2.1.0",
+        "tiles": [
+            "{}{{z}}/{{x}}/{{y}}".format(
+                _url_for(
+                    endpoint, prefix=make_prefix(), _external=True, _scheme="", **values
+                )
+            )
+        ],
+    }
+
+    return Response(json_dumps(tilejson), mimetype="application/json")
+
+
+def _render_wmts(catalog, base_url):
+    # the rendered template is escaped, so the substituted value must be too
+    wmts = _wmts_skeleton(catalog).replace(WMTS_BASE_URL_PLACEHOLDER, escape(base_url))
+
+    return wmts, 200, {"Content-Type": "application/xml"}
+
+
+def _wmts_skeleton(catalog):
+    # everything but the base URL is fixed for a given catalog
+    try:
+        return WMTS_SKELETONS[catalog]
+    except KeyError:
+        pass
+
+    provider = "OpenAerialMap"
+    provider_url = "https://openaerialmap.org/"
+
+    if catalog.provider:
+        provider = "{} ({})".format(provider, catalog.provider)
+
+    skeleton = render_template(
+        WMTS_TEMPLATE,
+        base_url=WMTS_BASE_URL_PLACEHOLDER,
+        bounds=catalog.bounds,
+        content_type="image/png",
+        ext="png",
+        id=catalog.id,
+        maxzoom=catalog.maxzoom,
+        metadata_url=catalog.metadata_url,
+        minzoom=catalog.minzoom,
+        provider=provider,
+        provider_url=provider_url,
+        title=catalog.name,
+    )
+
+    WMTS_SKELETONS[catalog] = skeleton
+
+    return skeleton
+
+
+def _render_tile(tile, catalog, format, scale):
+    # concurrent requests for the same tile (e.g. from several map viewers
+    # panning the same scene) share a single render
+    etag, headers, data = _get_or_load(
+        TILE_CACHE,
+        (tile, catalog, format, scale),
+        partial(_load_tile, tile, catalog, format, scale),
+    )
+
+    headers = dict(headers)
+    headers.update(catalog.headers)
+
+    if request.if_none_match.contains(etag):
+        return "", 304, headers
+
+    headers["Content-Length"] = str(len(data))
+
+    # the body is already encoded; hand it to the WSGI server as-is
+    return Response(data, 200, headers, direct_passthrough=True)
+
+
+def _load_tile(tile, catalog, format, scale):
+    headers, data = tiling.render_tile(
+        tile, catalog, format=format, transformation=IMAGE_TRANSFORMATION, scale=scale
+    )
+
+    etag = hashlib.sha1(data).hexdigest()
+    headers["ETag"] = quote_etag(etag)
+
+    return etag, headers, data
+
+
+def _url_for(endpoint, **values):
+    return _memoized_url_for(request.url_root, endpoint, **values)
+
+
+# external URLs depend on the scheme and host being requested, so key on them too
+@lru_cache(maxsize=4096)
+def _memoized_url_for(url_root, endpoint, **values):
+    return url_for(endpoint, **values)
+
+
 def make_prefix():
     host = request.headers.get("X-Forwarded-Host", request.headers.get("Host", ""))
 
-    # sniff for API Gateway
-    if ".execute-api." in host and ".amazonaws.com" in host:
+    if _is_api_gateway(host):
         return request.headers.get("X-Stage")
 
 
+def _is_api_gateway(host):
+    return ".execute-api." in host and ".amazonaws.com" in host
+
+
 @app.route("/<path:id>/<int:scene_idx>/")
 @app.route("/<path:id>/<int:scene_idx>/<image_id>/")
 @app.route("/<prefix>/<path:id>/<int:scene_idx>/")
@@ -85,35 +345,13 @@ def meta(id, scene_idx, image_id=None, prefix=None):
     # prefix is for URL generation only (API Gateway stages); if it matched the
     # URL, it's part of the id
     if prefix is not None:
-        id = "/".join([prefix, id])
+        id = prefix + "/" + id
 
     catalog = make_catalog(id, scene_idx, image_id)
 
-    meta = {
-        "bounds": catalog.bounds,
-        "center": catalog.center,
-        "maxzoom": catalog.maxzoom,
-        "minzoom": catalog.minzoom,
-        "name": catalog.name,
-        "tilejson": "2.1.0",
-    }
-
-    with app.app_context():
-        meta["tiles"] = [
-            "{}{{z}}/{{x}}/{{y}}".format(
-                url_for(
-                    "meta",
-                    id=id,
-                    scene_idx=scene_idx,
-                    image_id=image_id,
-                    prefix=make_prefix(),
-                    _external=True,
-                    _scheme="",
-                )
-            )
-        ]
-
-    return jsonify(meta)
+    return _render_tilejson(
+        catalog, "meta", id=id, scene_idx=scene_idx, image_id=image_id
+    )
 
 
 @app.route("/user/<path:id>/")
@@ -121,25 +359,7 @@ def meta(id, scene_idx, image_id=None, prefix=None):
 def user_meta(id, prefix=None):
     catalog = make_remote_catalog("user", id)
 
-    meta = {
-        "bounds": catalog.bounds,
-        "center": catalog.center,
-        "maxzoom": catalog.maxzoom,
-        "minzoom": catalog.minzoom,
-        "name": catalog.name,
-        "tilejson": "2.1.0",
-    }
-
-    with app.app_context():
-        meta["tiles"] = [
-            "{}{{z}}/{{x}}/{{y}}".format(
-                url_for(
-                    "user_meta", id=id, prefix=make_prefix(), _external=True, _scheme=""
-                )
-            )
-        ]
-
-    return jsonify(meta)
+    return _render_tilejson(catalog, "user_meta", id=id)
 
 
 @app.route("/<path:id>/<int:scene_idx>/wmts")
@@ -150,42 +370,20 @@ def wmts(id, scene_idx, image_id=None, prefix=None):
     # prefix is for URL generation only (API Gateway stages); if it matched the
     # URL, it's part of the id
     if prefix is not None:
-        id = "/".join([prefix, id])
+        id = prefix + "/" + id
 
     catalog = make_catalog(id, scene_idx, image_id)
 
-    provider = "OpenAerialMap"
-    provider_url = "https://openaerialmap.org/"
-
-    if catalog.provider:
-        provider = "{} ({})".format(provider, catalog.provider)
-
-    with app.app_context():
-        base_url = url_for(
-            "meta",
-            id=id,
-            scene_idx=scene_idx,
-            image_id=image_id,
-            prefix=make_prefix(),
-            _external=True,
-        )
+    base_url = _url_for(
+        "meta",
+        id=id,
+        scene_idx=scene_idx,
+        image_id=image_id,
+        prefix=make_prefix(),
+        _external=True,
+    )
 
-        return render_template(
-            "wmts.xml",
-            base_url=base_url,
-            bounds=catalog.bounds,
-            content_type="image/png",
-            ext="png",
-            id=catalog.id,
-            maxzoom=catalog.maxzoom,
-            metadata_url=catalog.metadata_url,
-            minzoom=catalog.minzoom,
-            provider=provider,
-            provider_url=provider_url,
-            title=catalog.name,
-        ), 200, {
-            "Content-Type": "application/xml"
-        }
+    return _render_wmts(catalog, base_url)
 
 
 @app.route("/user/<path:id>/wmts")
@@ -193,31 +391,9 @@ def wmts(id, scene_idx, image_id=None, prefix=None):
 def user_wmts(id, prefix=None):
     catalog = make_remote_catalog("user", id)
 
-    provider = "OpenAerialMap"
-    provider_url = "https://openaerialmap.org/"
+    base_url = _url_for("user_meta", id=id, prefix=make_prefix(), _external=True)
 
-    if catalog.provider:
-        provider = "{} ({})".format(provider, catalog.provider)
-
-    with app.app_context():
-        base_url = url_for("user_meta", id=id, prefix=make_prefix(), _external=True)
-
-        return render_template(
-            "wmts.xml",
-            base_url=base_url,
-            bounds=catalog.bounds,
-            content_type="image/png",
-            ext="png",
-            id=catalog.id,
-            maxzoom=catalog.maxzoom,
-            metadata_url=catalog.metadata_url,
-            minzoom=catalog.minzoom,
-            provider=provider,
-            provider_url=provider_url,
-            title=catalog.name,
-        ), 200, {
-            "Content-Type": "application/xml"
-        }
+    return _render_wmts(catalog, base_url)
 
 
 @app.route("/<path:id>/<int:scene_idx>/preview")
@@ -228,43 +404,45 @@ def preview(id, scene_idx, image_id=None, prefix=None):
     # prefix is for URL generation only (API Gateway stages); if it matched the
     # URL, it's part of the id
     if prefix is not None:
-        id = "/".join([prefix, id])
-
-    # load the catalog so it will fail if the source doesn't exist
-    make_catalog(id, scene_idx, image_id)
-
-    with app.app_context():
-        return render_template(
-            "preview.html",
-            tilejson_url=url_for(
-                "meta",
-                id=id,
-                scene_idx=scene_idx,
-                image_id=image_id,
-                prefix=make_prefix(),
-                _external=True,
-                _scheme="",
-            ),
-        ), 200, {
-            "Content-Type": "text/html"
-        }
+        id = prefix + "/" + id
+
+    # fail if the source doesn't exist
+    _check_exists(
+        CATALOG_CACHE,
+        (id, scene_idx, image_id),
+        catalog_url(id, scene_idx, image_id),
+    )
+
+    return render_template(
+        "preview.html",
+        tilejson_url=_url_for(
+            "meta",
+            id=id,
+            scene_idx=scene_idx,
+            image_id=image_id,
+            prefix=make_prefix(),
+            _external=True,
+            _scheme="",
+        ),
+    ), 200, {
+        "Content-Type": "text/html"
+    }
 
 
 @app.route("/user/<path:id>/preview")
 @app.route("/<prefix>/user/<path:id>/preview")
 def user_preview(id, prefix=None):
-    # load the catalog so it will fail if the source doesn't exist
-    make_remote_catalog("user", id)
-
-    with app.app_context():
-        return render_template(
-            "preview.html",
-            tilejson_url=url_for(
-                "user_meta", id=id, prefix=make_prefix(), _external=True, _scheme=""
-            ),
-        ), 200, {
-            "Content-Type": "text/html"
-        }
+    # fail if the source doesn't exist
+    _check_exists(REMOTE_CATALOG_CACHE, ("user", id), remote_catalog_url("user", id))
+
+    return render_template(
+        "preview.html",
+        tilejson_url=_url_for(
+            "user_meta", id=id, prefix=make_prefix(), _external=True, _scheme=""
+        ),
+    ), 200, {
+        "Content-Type": "text/html"
+    }
 
 
 @app.route("/<path:id>/<int:scene_idx>/<int:z>/<int:x>/<int:y>.png")
@@ -285,22 +463,12 @@ def render_png(id, scene_idx, z, x, y, image_id=None, scale=1, prefix=None):
     # prefix is for URL generation only (API Gateway stages); if it matched the
     # URL, it's part of the id
     if prefix is not None:
-        id = "/".join([prefix, id])
+        id = prefix + "/" + id
 
     catalog = make_catalog(id, scene_idx, image_id)
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
-        tile,
-        catalog,
-        format=PNG_FORMAT,
-        transformation=IMAGE_TRANSFORMATION,
-        scale=scale,
-    )
-
-    headers.update(catalog.headers)
-
-    return data, 200, headers
+    return _render_tile(tile, catalog, PNG_FORMAT, scale)
 
 
 @app.route("/<path:id>/<int:scene_idx>/<int:z>/<int:x>/<int:y>")
@@ -317,22 +485,12 @@ def render(id, scene_idx, z, x, y, image_id=None, scale=1, prefix=None):
     # prefix is for URL generation only (API Gateway stages); if it matched the
     # URL, it's part of the id
     if prefix is not None:
-        id = "/".join([prefix, id])
+        id = prefix + "/" + id
 
     catalog = make_catalog(id, scene_idx, image_id)
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
-        tile,
-        catalog,
-        format=OPTIMAL_FORMAT,
-        transformation=IMAGE_TRANSFORMATION,
-        scale=scale,
-    )
-
-    headers.update(catalog.headers)
-
-    return data, 200, headers
+    return _render_tile(tile, catalog, OPTIMAL_FORMAT, scale)
 
 
 @app.route("/user/<path:id>/<int:z>/<int:x>/<int:y>.png")
@@ -343,17 +501,7 @@ def user_render_png(id, z, x, y, scale=1, prefix=None):
     catalog = make_remote_catalog("user", id)
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
-        tile,
-        catalog,
-        format=PNG_FORMAT,
-        transformation=IMAGE_TRANSFORMATION,
-        scale=scale,
-    )
-
-    headers.update(catalog.headers)
-
-    return data, 200, headers
+    return _render_tile(tile, catalog, PNG_FORMAT, scale)
 
 
 @app.route("/user/<path:id>/<int:z>/<int:x>/<int:y>")
@@ -364,14 +512,4 @@ def user_render(id, z, x, y, scale=1, prefix=None):
     catalog = make_remote_catalog("user", id)
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
-        tile,
-        catalog,
-        format=OPTIMAL_FORMAT,
-        transformation=IMAGE_TRANSFORMATION,
-        scale=scale,
-    )
-
-    headers.update(catalog.headers)
-
-    return data, 200, headers
+    return _render_tile(tile, catalog, OPTIMAL_FORMAT, scale)